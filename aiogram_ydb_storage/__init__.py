@@ -1,4 +1,4 @@
-from .storage import YDBStorage
+from .storage import SessionPoolTimeout, YDBStorage
 
 
-__all__ = ["YDBStorage"]
+__all__ = ["SessionPoolTimeout", "YDBStorage"]
@@ -1,16 +1,79 @@
 import asyncio
+import contextlib
+import functools
+import re
+import sys
 from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.state import State
-from typing import Any, Dict, Optional
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
 
 import ydb
 import pickle
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+_MISSING = object()
+
+# Upper bound for the delay between retries of a failing flush, seconds
+_FLUSH_BACKOFF_MAX = 5.0
+
+# Compact UTF-8 output, the same as orjson produces
+_json_dumps = functools.partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
+
+
+def _orjson_dumps(obj: object) -> bytes:
+    """
+    orjson with the same input range as stdlib json
+    """
+    try:
+        # stdlib json turns int/float/bool/None keys into strings too
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # e.g. integers over 64 bits, which stdlib json accepts
+        return _json_dumps(obj).encode()
+
+
+# 20+ digits may be an integer over 64 bits, which orjson reads as a float
+_BIG_INT = re.compile(r"\d{20}")
+_BIG_INT_BYTES = re.compile(rb"\d{20}")
+
+
+def _orjson_loads(obj: str | bytes) -> Any:
+    """
+    orjson that reads everything stdlib json reads, with the same result
+    """
+    pattern = _BIG_INT if isinstance(obj, str) else _BIG_INT_BYTES
+    if pattern.search(obj) is None:
+        try:
+            return orjson.loads(obj)
+        except orjson.JSONDecodeError:
+            # e.g. NaN and Infinity, which stdlib json writes by default
+            pass
+    return json.loads(obj)
+
+
+class SessionPoolTimeout(Exception):
+    """No free YDB session within acquire_timeout"""
+
+
+@functools.lru_cache(maxsize=65536)
+def _fmt_key(bot_id: int, chat_id: int, user_id: int) -> str:
+    return f"{bot_id}:{chat_id}:{user_id}"
+
 
 class YDBStorage(BaseStorage):
     """YDB storage for FSM"""
@@ -18,51 +81,202 @@ class YDBStorage(BaseStorage):
     def __init__(
         self,
         driver_config: ydb.DriverConfig = None,
-        session_pool: ydb.SessionPool = None,
+        session_pool: ydb.aio.QuerySessionPool = None,
         serializing_method: str = "json",
         table_name: str = "fsm_storage",
+        flush_interval: Optional[float] = None,
+        pool_size: int = 50,
+        acquire_timeout: float = 5.0,
+        state_cache_size: int = 0,
     ) -> None:
+        """
+        :param driver_config: YDB driver config
+        :param session_pool: existing session pool, created from driver_config if None
+        :param serializing_method: "json" (default), "orjson", "msgpack" or "pickle"
+        :param table_name: name of the FSM table
+        :param flush_interval: if set, writes are buffered in memory and flushed
+            in batches every flush_interval seconds (e.g. 0.05). Buffered writes
+            are lost if the process dies before close()
+        :param pool_size: max number of YDB sessions, ignored if session_pool is passed
+        :param acquire_timeout: seconds to wait for a free session. If none frees up,
+            the operation fails with SessionPoolTimeout without retrying
+        :param state_cache_size: if set, keep the states of this many recent keys
+            in memory. Only safe when this process is the only writer
+        """
 
-        # Database
-        self.driver = ydb.Driver(driver_config) if driver_config else None
-        # self.driver_ = ydb.aio.Driver(driver_config)
-
-        self.session_pool = (
-            ydb.SessionPool(self.driver) if session_pool is None else session_pool
+        if driver_config is None and session_pool is None:
+            raise ValueError("YDBStorage needs either driver_config or session_pool")
+
+        # Database. The driver and the pool need a running event loop,
+        # so they are created in start(), or on first use
+        self.driver_config = driver_config
+        self.driver: Optional[ydb.aio.Driver] = None
+        self.session_pool = session_pool
+        self._started = False
+        self._start_lock = asyncio.Lock()
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.retry_settings = ydb.RetrySettings()
+        self.request_settings = (
+            ydb.BaseRequestSettings().with_timeout(3).with_operation_timeout(2)
         )
 
         # Settigns
         self.table_name = table_name
 
         self.serializing_method = serializing_method
-        if self.serializing_method != "pickle" and self.serializing_method != "json":
+        if self.serializing_method not in ("pickle", "json", "orjson", "msgpack"):
+            self.serializing_method = "json"
+        if self.serializing_method == "msgpack" and msgpack is None:
+            logger.error("msgpack is not installed, falling back to json")
             self.serializing_method = "json"
 
-        # Create table
-        try:
-            asyncio.run(self._create_table())
-        except BaseException as e:
-            logger.error(f"FSM Storage error: {e}")
+        # Binary methods store raw bytes, so the data column must be String
+        self.data_type = (
+            "String"
+            if self.serializing_method in ("pickle", "orjson", "msgpack")
+            else "Utf8"
+        )
+
+        # Codec is resolved once, _ser/_dsr just call it
+        match self.serializing_method:
+            case "pickle":
+                self._dumps = functools.partial(
+                    pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL
+                )
+                self._loads = pickle.loads
+            case "msgpack":
+                self._dumps = functools.partial(msgpack.packb, use_bin_type=True)
+                # FSM data may have non-str keys, which packb accepts
+                self._loads = functools.partial(
+                    msgpack.unpackb, raw=False, strict_map_key=False
+                )
+            case "orjson":
+                self._dumps = (
+                    _orjson_dumps if orjson else lambda o: _json_dumps(o).encode()
+                )
+                self._loads = _orjson_loads if orjson else json.loads
+            case "json" | _:
+                self._dumps = (
+                    (lambda o: _orjson_dumps(o).decode()) if orjson else _json_dumps
+                )
+                self._loads = _orjson_loads if orjson else json.loads
+
+        # Parameter types. Queries have no DECLARE blocks, YDB takes
+        # the types from the typed parameters
+        self._key_type = ydb.PrimitiveType.Utf8
+        self._state_type = ydb.PrimitiveType.Utf8
+        self._data_ydb_type = getattr(ydb.PrimitiveType, self.data_type)
+        self._rows_types = {
+            "state": ydb.ListType(
+                ydb.StructType()
+                .add_member("key", self._key_type)
+                .add_member("state", self._state_type)
+            ),
+            "data": ydb.ListType(
+                ydb.StructType()
+                .add_member("key", self._key_type)
+                .add_member("data", self._data_ydb_type)
+            ),
+            "both": ydb.ListType(
+                ydb.StructType()
+                .add_member("key", self._key_type)
+                .add_member("state", self._state_type)
+                .add_member("data", self._data_ydb_type)
+            ),
+        }
+
+        # Queries. The text is constant after init, so YDB's server-side
+        # compiled query cache hits on every call
+        self._q_create_table = f"""
+                CREATE TABLE IF NOT EXISTS `{self.table_name}` (
+                    `key` Utf8,
+                    `data` {self.data_type},
+                    `state` Utf8,
+                    PRIMARY KEY (`key`)
+                )
+                """
+        self._q_set_state = f"""
+                UPSERT INTO `{self.table_name}` (`key`, `state`)
+                VALUES ($k, $s)
+                """
+        self._q_get_state = f"""
+                SELECT state FROM `{self.table_name}`
+                WHERE `key` = $k
+                """
+        self._q_set_data = f"""
+                UPSERT INTO `{self.table_name}` (`key`, `data`)
+                VALUES ($k, $d)
+                """
+        # Data is always read as String: the SDK returns the raw bytes and
+        # the loader parses them without decoding a str first
+        self._q_get_data = f"""
+                SELECT CAST(data AS String) AS data FROM `{self.table_name}`
+                WHERE `key` = $k
+                """
+        # One flush writes a key with both state and data buffered as one row
+        self._q_flush = f"""
+                UPSERT INTO `{self.table_name}`
+                SELECT key, state FROM AS_TABLE($states);
+                UPSERT INTO `{self.table_name}`
+                SELECT key, data FROM AS_TABLE($data);
+                UPSERT INTO `{self.table_name}`
+                SELECT key, state, data FROM AS_TABLE($both);
+                """
+
+        # In-flight reads, shared by concurrent callers for the same key
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        # LRU cache of states: key -> state
+        self.state_cache_size = state_cache_size
+        self._state_cache: OrderedDict[str, Optional[str]] = OrderedDict()
+
+        # Write-back buffer: kind -> {key: serialized value}
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, Dict[str, Any]] = {"state": {}, "data": {}}
+        self._flushing: Dict[str, Dict[str, Any]] = {"state": {}, "data": {}}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        """
+        Connect to the database and create table.
+        Called on the first storage operation if it wasn't awaited before,
+        e.g. on dispatcher startup
+        """
+        async with self._start_lock:
+            if self._started:
+                return
+
+            if self.session_pool is None:
+                driver = ydb.aio.Driver(self.driver_config)
+                try:
+                    await driver.wait(fail_fast=True)
+                except BaseException:
+                    # the next operation starts over, don't leak this driver
+                    await driver.stop()
+                    raise
+                self.driver = driver
+                self.session_pool = ydb.aio.QuerySessionPool(
+                    self.driver, size=self.pool_size
+                )
+
+            # set before the table is created, its query mustn't start again
+            self._started = True
+            await self._create_table()
 
     def _key(self, key: StorageKey) -> str:
         """
         Create a key for every uniqe user, chat and bot
         """
-        result_string = (
-            str(key.bot_id) + ":" + str(key.chat_id) + ":" + str(key.user_id)
-        )
-        return result_string
+        return _fmt_key(key.bot_id, key.chat_id, key.user_id)
 
     def _ser(self, obj: object) -> str | bytes | None:
         """
         Serialize object
         """
         try:
-            match self.serializing_method:
-                case "pickle":
-                    return pickle.dumps(obj)
-                case "json" | _:
-                    return json.dumps(obj)
+            return self._dumps(obj)
         except Exception as e:
             logger.error(f"Serializing error! {e}")
             return None
@@ -71,74 +285,199 @@ class YDBStorage(BaseStorage):
         """
         Deserialize object
         """
+        if obj is None:
+            return None
         try:
-            match self.serializing_method:
-                case "pickle":
-                    return pickle.loads(obj) if obj else None
-                case "json" | _:
-                    return json.loads(obj) if obj else None
+            return self._loads(obj)
         except Exception as e:
             logger.error(
                 f"Deserializing error! Probably, unsupported serializing method was used. {e}"
             )
             return None
 
+    async def _single_flight(
+        self, kind: str, s_key: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Run fetch once for all concurrent callers asking for the same key
+        """
+        flight_key = (kind, s_key)
+        task = self._inflight.get(flight_key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[flight_key] = task
+            task.add_done_callback(
+                lambda t: self._inflight.pop(flight_key, None)
+                if self._inflight.get(flight_key) is t
+                else None
+            )
+        # shield: a cancelled caller must not cancel the read for the others
+        return await asyncio.shield(task)
+
+    def _drop_inflight(self, kind: str, s_key: str) -> None:
+        """
+        Forget an in-flight read, so reads after a write don't join a stale one
+        """
+        self._inflight.pop((kind, s_key), None)
+
+    def _cache_state(self, s_key: str, s_state: Optional[str]) -> None:
+        """
+        Put state into the LRU cache, evicting the oldest key
+        """
+        if not self.state_cache_size:
+            return
+        self._state_cache[s_key] = s_state
+        self._state_cache.move_to_end(s_key)
+        if len(self._state_cache) > self.state_cache_size:
+            self._state_cache.popitem(last=False)
+
+    def _buffered(self, kind: str, s_key: str) -> Any:
+        """
+        Get a value not yet written to the database, or _MISSING
+        """
+        value = self._pending[kind].get(s_key, _MISSING)
+        if value is _MISSING:
+            value = self._flushing[kind].get(s_key, _MISSING)
+        return value
+
+    def _buffer(self, kind: str, s_key: str, value: Any) -> None:
+        """
+        Put a write into the buffer and make sure a flush is scheduled
+        """
+        self._pending[kind][s_key] = value
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        """
+        Flush until the buffer is empty, backing off while flushes fail
+        """
+        delay = self.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            flushed = await self._flush_pending()
+            # writes made during the flush, or values put back after a failure
+            if not self._pending["state"] and not self._pending["data"]:
+                return
+            delay = (
+                self.flush_interval
+                if flushed
+                else min(max(delay, 0.05) * 2, _FLUSH_BACKOFF_MAX)
+            )
+
+    async def _flush_pending(self) -> bool:
+        """
+        Write all buffered values in one transaction
+
+        :return: False if the write failed and the values were put back
+        """
+        async with self._flush_lock:
+            states, datas = self._pending["state"], self._pending["data"]
+            if not states and not datas:
+                return True
+            self._pending = {"state": {}, "data": {}}
+            self._flushing = {"state": states, "data": datas}
+
+            state_rows, both_rows = [], []
+            for k, v in states.items():
+                if k in datas:
+                    both_rows.append({"key": k, "state": v, "data": datas[k]})
+                else:
+                    state_rows.append({"key": k, "state": v})
+            data_rows = [
+                {"key": k, "data": v} for k, v in datas.items() if k not in states
+            ]
+
+            try:
+                await self._execute_query(
+                    self._q_flush,
+                    {
+                        "$states": (state_rows, self._rows_types["state"]),
+                        "$data": (data_rows, self._rows_types["data"]),
+                        "$both": (both_rows, self._rows_types["both"]),
+                    },
+                )
+            except BaseException as e:
+                logger.error(f"FSM Storage error: {e}")
+                if not self._is_transient(e):
+                    # retrying can't help, and would block every later write
+                    logger.error(
+                        f"FSM Storage dropped {len(states) + len(datas)} buffered writes"
+                    )
+                    return True
+                # keep unsaved values unless they were overwritten meanwhile
+                for kind, batch in (("state", states), ("data", datas)):
+                    for k, v in batch.items():
+                        self._pending[kind].setdefault(k, v)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                return False
+            finally:
+                self._flushing = {"state": {}, "data": {}}
+
+            return True
+
+    def _is_transient(self, e: BaseException) -> bool:
+        """
+        Whether a failed write may succeed later
+        """
+        if isinstance(
+            e,
+            (
+                SessionPoolTimeout,
+                ConnectionError,
+                asyncio.TimeoutError,
+                asyncio.CancelledError,
+            ),
+        ):
+            return True
+        if isinstance(e, ydb.Error):
+            return ydb.check_retriable_error(e, self.retry_settings, 0).is_retriable
+        return False
+
+    async def _retry(self, callee: Callable[[Any], Awaitable[Any]]) -> Any:
+        """
+        Run callee with a pool session, retrying retriable YDB errors
+        """
+        if not self._started:
+            await self.start()
+
+        async def attempt():
+            try:
+                session = await self.session_pool.acquire(timeout=self.acquire_timeout)
+            except ydb.SessionPoolEmpty:
+                # Not a YDB error, so it isn't retried: a pool that is full now
+                # would only make every retry wait acquire_timeout again
+                raise SessionPoolTimeout(
+                    f"No free YDB session in {self.acquire_timeout} s"
+                ) from None
+            try:
+                return await callee(session)
+            finally:
+                await self.session_pool.release(session)
+
+        return await ydb.retry_operation_async(attempt, self.retry_settings)
+
     async def _execute_query(self, query: str, parameters: dict = None):
         """Execute YQL query"""
 
-        async def callee(session_pool):
-            with session_pool.async_checkout() as session_holder:
-                try:
-                    # wait for the session checkout to complete.
-                    session = await asyncio.wait_for(
-                        asyncio.wrap_future(session_holder), timeout=5
-                    )
-                except asyncio.TimeoutError:
-                    raise ydb.SessionPoolEmpty("")
-
-                prepared_query = session.prepare(query)
-
-                return await asyncio.wrap_future(
-                    session.transaction().async_execute(
-                        prepared_query,
-                        parameters,
-                        commit_tx=True,
-                        settings=ydb.BaseRequestSettings()
-                        .with_timeout(3)
-                        .with_operation_timeout(2),
-                    )
+        async def callee(session):
+            return [
+                result_set
+                async for result_set in await session.execute(
+                    query, parameters, settings=self.request_settings
                 )
+            ]
 
-        return await ydb.aio.retry_operation(callee, None, self.session_pool)
+        return await self._retry(callee)
 
     async def _create_table(self):
         """
         Create table if not exists
         """
 
-        query = f"""
-                CREATE table `{self.table_name}` (
-                    `key` Utf8,
-                    `data` Utf8,
-                    `state` Utf8,
-                    PRIMARY KEY (`key`)
-                )
-                """
-
-        async def callee(session_pool):
-            with session_pool.async_checkout() as session_holder:
-                try:
-                    # wait for the session checkout to complete.
-                    session = await asyncio.wait_for(
-                        asyncio.wrap_future(session_holder), timeout=5
-                    )
-                except asyncio.TimeoutError:
-                    raise ydb.SessionPoolEmpty("")
-
-                return await asyncio.wrap_future(session.execute_scheme(query))
-
         try:
-            return await ydb.aio.retry_operation(callee, None, self.session_pool)
+            return await self._execute_query(self._q_create_table)
         except BaseException as e:
             logger.error(f"FSM Storage error: {e}")
 
@@ -152,23 +491,26 @@ class YDBStorage(BaseStorage):
         s_key = self._key(key)
         s_state = state.state if isinstance(state, State) else state
         s_state = s_state if s_state else ""
+        self._drop_inflight("state", s_key)
+
+        if self.flush_interval is not None:
+            self._buffer("state", s_key, s_state)
+            self._cache_state(s_key, s_state or None)
+            return
 
         try:
-            query = f"""
-                    DECLARE $k AS Utf8;
-                    DECLARE $s AS Utf8;
-                    UPSERT INTO `{self.table_name}` (`key`, `state`)
-                    VALUES ($k, $s)
-                    """
             await self._execute_query(
-                query,
+                self._q_set_state,
                 {
-                    "$k": s_key,
-                    "$s": s_state,
+                    "$k": (s_key, self._key_type),
+                    "$s": (s_state, self._state_type),
                 },
             )
+            self._cache_state(s_key, s_state or None)
 
         except BaseException as e:
+            # the stored state is unknown now
+            self._state_cache.pop(s_key, None)
             logger.error(f"FSM Storage error: {e}")
 
     async def get_state(self, key: StorageKey) -> Optional[str]:
@@ -180,20 +522,38 @@ class YDBStorage(BaseStorage):
         """
         s_key = self._key(key)
 
+        s_state = self._buffered("state", s_key)
+        if s_state is not _MISSING:
+            return s_state or None
+
+        s_state = self._state_cache.get(s_key, _MISSING)
+        if s_state is not _MISSING:
+            self._state_cache.move_to_end(s_key)
+            return s_state
+
+        return await self._single_flight(
+            "state", s_key, lambda: self._get_state(s_key)
+        )
+
+    async def _get_state(self, s_key: str) -> Optional[str]:
+        """
+        Read state from the database
+        """
         try:
-            query = f"""
-                    DECLARE $k AS Utf8;
-                    SELECT state FROM `{self.table_name}`
-                    WHERE `key` = $k
-                    """
             result = await self._execute_query(
-                query,
+                self._q_get_state,
                 {
-                    "$k": s_key,
+                    "$k": (s_key, self._key_type),
                 },
             )
 
-            return result[0].rows[0].get("state") if result[0].rows else None
+            s_state = result[0].rows[0].get("state") if result[0].rows else None
+            # states are a small fixed set, interned strings compare by identity
+            s_state = sys.intern(s_state) if s_state else None
+            # don't overwrite a state written by set_state while reading
+            if s_key not in self._state_cache:
+                self._cache_state(s_key, s_state)
+            return s_state
 
         except BaseException as e:
             logger.error(f"FSM Storage error: {e}")
@@ -207,19 +567,21 @@ class YDBStorage(BaseStorage):
         """
         s_key = self._key(key)
         s_data = self._ser(data)
+        if s_data is None:
+            # _ser has logged the error, the stored data is left as it was
+            return
+        self._drop_inflight("data", s_key)
+
+        if self.flush_interval is not None:
+            self._buffer("data", s_key, s_data)
+            return
 
         try:
-            query = f"""
-                    DECLARE $k AS Utf8;
-                    DECLARE $d AS Utf8;
-                    UPSERT INTO `{self.table_name}` (`key`, `data`)
-                    VALUES ($k, $d)
-                    """
             await self._execute_query(
-                query,
+                self._q_set_data,
                 {
-                    "$k": s_key,
-                    "$d": s_data,
+                    "$k": (s_key, self._key_type),
+                    "$d": (s_data, self._data_ydb_type),
                 },
             )
         except BaseException as e:
@@ -234,16 +596,23 @@ class YDBStorage(BaseStorage):
         """
         s_key = self._key(key)
 
+        s_data = self._buffered("data", s_key)
+        if s_data is not _MISSING:
+            return self._dsr(s_data)
+
+        data = await self._single_flight("data", s_key, lambda: self._get_data(s_key))
+        # every caller gets its own copy of the shared result
+        return data.copy() if data is not None else None
+
+    async def _get_data(self, s_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Read data from the database
+        """
         try:
-            query = f"""
-                    DECLARE $k AS Utf8;
-                    SELECT data FROM `{self.table_name}`
-                    WHERE `key` = $k
-                    """
             result = await self._execute_query(
-                query,
+                self._q_get_data,
                 {
-                    "$k": s_key,
+                    "$k": (s_key, self._key_type),
                 },
             )
 
@@ -263,11 +632,62 @@ class YDBStorage(BaseStorage):
         :param data: partial data
         :return: new data
         """
-        current_data = await self.get_data(key=key)
-        if not current_data:
-            current_data = {}
-        current_data.update(data)
-        await self.set_data(key=key, data=current_data)
+        if self.flush_interval is not None:
+            # buffered writes are merged in memory and flushed later
+            current_data = await self.get_data(key=key) or {}
+            # a concurrent update may have buffered data while this one was
+            # reading, merge into that; no await until set_data buffers it
+            s_data = self._buffered("data", self._key(key))
+            if s_data is not _MISSING:
+                current_data = self._dsr(s_data) or {}
+            current_data.update(data)
+            await self.set_data(key=key, data=current_data)
+            return current_data.copy()
+
+        s_key = self._key(key)
+        current_data = {}
+        self._drop_inflight("data", s_key)
+
+        async def callee(session):
+            # Read and write in one transaction: no second commit and
+            # no window for a concurrent writer between them
+            async with session.transaction() as tx:
+                result = [
+                    result_set
+                    async for result_set in await tx.execute(
+                        self._q_get_data,
+                        {"$k": (s_key, self._key_type)},
+                        settings=self.request_settings,
+                    )
+                ]
+
+                merged = (
+                    self._dsr(result[0].rows[0].get("data"))
+                    if result and result[0].rows
+                    else None
+                )
+                if not merged:
+                    merged = {}
+                merged.update(data)
+
+                async for _ in await tx.execute(
+                    self._q_set_data,
+                    {
+                        "$k": (s_key, self._key_type),
+                        "$d": (self._ser(merged), self._data_ydb_type),
+                    },
+                    commit_tx=True,
+                    settings=self.request_settings,
+                ):
+                    pass
+            return merged
+
+        try:
+            current_data = await self._retry(callee)
+        except BaseException as e:
+            logger.error(f"FSM Storage error: {e}")
+            current_data.update(data)
+
         return current_data.copy()
 
     async def close(self) -> None:
@@ -275,5 +695,23 @@ class YDBStorage(BaseStorage):
         Close storage (database connection, file or etc.)
         """
 
-        # logger.debug("FSM Storage database has been closed.")
-        pass
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            # a flush cancelled mid-query puts its values back for the one below
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+        # the buffer needs the pool, so it is flushed before anything stops
+        await self._flush_pending()
+
+        # a pool passed by the caller is left for the caller to stop
+        if self.driver is not None:
+            try:
+                await self.session_pool.stop()
+                await self.driver.stop()
+            except BaseException as e:
+                logger.error(f"FSM Storage error: {e}")
+            self.session_pool = None
+            self.driver = None
+            self._started = False
+
+        logger.debug("FSM Storage database has been closed.")
@@ -17,6 +17,7 @@ driver_config = ydb.DriverConfig(
 my_storage = YDBStorage(driver_config=driver_config)
 
 dp = Dispatcher(storage=my_storage)
+dp.startup.register(my_storage.start)
 bot = Bot("token")
 
 
@@ -0,0 +1,307 @@
+import asyncio
+import math
+from types import SimpleNamespace
+
+import pytest
+import ydb
+from aiogram.fsm.storage.base import StorageKey
+
+from aiogram_ydb_storage.storage import SessionPoolTimeout, YDBStorage
+
+
+@pytest.mark.parametrize("method", ["json", "orjson"])
+def test_json_methods_accept_non_str_keys(method):
+    storage = YDBStorage(session_pool=object(), serializing_method=method)
+
+    s_data = storage._ser({1: "a", None: 2, "b": "я"})
+
+    assert s_data is not None
+    assert storage._dsr(s_data) == {"1": "a", "null": 2, "b": "я"}
+
+
+@pytest.mark.parametrize("method", ["json", "orjson"])
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"n": 2**70, "m": -(2**64), "k": 2**64 - 1},
+        {"s": "12345678901234567890", "f": 0.1, "nested": {"l": [1, "я", None]}},
+    ],
+)
+def test_json_methods_round_trip(method, data):
+    storage = YDBStorage(session_pool=object(), serializing_method=method)
+
+    assert storage._dsr(storage._ser(data)) == data
+
+
+@pytest.mark.parametrize("method", ["json", "orjson"])
+def test_json_methods_read_legacy_rows(method):
+    storage = YDBStorage(session_pool=object(), serializing_method=method)
+
+    # stdlib json.dumps writes these by default, orjson.loads rejects them
+    data = storage._dsr(b'{"nan": NaN, "inf": Infinity}')
+
+    assert math.isnan(data["nan"])
+    assert data["inf"] == math.inf
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    storage = YDBStorage(session_pool=object(), serializing_method="msgpack")
+    data = {1: "a", "b": {2: [1, "я", None]}, "c": b"raw"}
+
+    assert storage._dsr(storage._ser(data)) == data
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=2, user_id=user_id)
+
+
+class FakeDatabase:
+    """Records flushed rows, each query takes `delay` seconds"""
+
+    def __init__(
+        self,
+        delay: float = 0.0,
+        failures: int = 0,
+        error: Exception = ConnectionError("database is unavailable"),
+    ) -> None:
+        self.delay = delay
+        self.failures = failures
+        self.error = error
+        self.flushes: list[dict] = []
+        self.rows: dict[str, dict] = {}
+
+    async def execute(self, query: str, parameters: dict = None):
+        # parameters are converted as the SDK does before sending
+        ydb.convert.query_parameters_to_pb(parameters)
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        if "$k" in parameters:
+            return [SimpleNamespace(rows=[])]  # reads find nothing
+        flush = {k: v[0] for k, v in parameters.items()}
+        self.flushes.append(flush)
+        for row in flush["$states"] + flush["$data"] + flush["$both"]:
+            self.rows.setdefault(row["key"], {}).update(row)
+
+
+def _buffered_storage(database: FakeDatabase) -> YDBStorage:
+    storage = YDBStorage(session_pool=object(), flush_interval=0.01)
+    storage._execute_query = database.execute
+    return storage
+
+
+def test_write_during_flush_is_flushed():
+    async def scenario():
+        database = FakeDatabase(delay=0.05)
+        storage = _buffered_storage(database)
+
+        await storage.set_state(_key(1), "a")
+        await asyncio.sleep(0.02)  # the first flush is running now
+        await storage.set_state(_key(2), "b")
+        await asyncio.sleep(0.5)
+
+        assert storage._pending == {"state": {}, "data": {}}
+        assert [f["$states"] for f in database.flushes] == [
+            [{"key": "1:2:1", "state": "a"}],
+            [{"key": "1:2:2", "state": "b"}],
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_is_retried():
+    async def scenario():
+        database = FakeDatabase(failures=2)
+        storage = _buffered_storage(database)
+
+        await storage.set_state(_key(1), "a")
+        await asyncio.sleep(0.6)
+
+        assert storage._pending == {"state": {}, "data": {}}
+        assert database.flushes[0]["$states"] == [{"key": "1:2:1", "state": "a"}]
+
+    asyncio.run(scenario())
+
+
+def test_buffered_values_are_readable_before_flush():
+    async def scenario():
+        database = FakeDatabase(delay=0.05)
+        storage = _buffered_storage(database)
+
+        await storage.set_state(_key(1), "a")
+        await storage.update_data(_key(1), {"x": 1})
+        await storage.update_data(_key(1), {"y": 2})
+
+        assert await storage.get_state(_key(1)) == "a"
+        assert await storage.get_data(_key(1)) == {"x": 1, "y": 2}
+
+        await storage.close()
+        assert database.rows == {
+            "1:2:1": {"key": "1:2:1", "state": "a", "data": '{"x":1,"y":2}'}
+        }
+
+    asyncio.run(scenario())
+
+
+class FakeSession:
+    def __init__(self, queries: list[str]) -> None:
+        self.queries = queries
+
+    async def execute(self, query, parameters=None, **kwargs):
+        self.queries.append(query.split()[0])
+
+        async def result_sets():
+            yield SimpleNamespace(rows=[])  # reads find nothing
+
+        return result_sets()
+
+
+class FakeSessionPool:
+    """Records executed queries, or times out on acquire if exhausted"""
+
+    def __init__(self, exhausted: bool = False) -> None:
+        self.exhausted = exhausted
+        self.acquired = 0
+        self.queries: list[str] = []
+
+    async def acquire(self, timeout=None):
+        self.acquired += 1
+        if self.exhausted:
+            raise ydb.SessionPoolEmpty("Timeout on acquire session")
+        return FakeSession(self.queries)
+
+    async def release(self, session) -> None:
+        pass
+
+
+def test_storage_starts_on_first_use():
+    async def scenario():
+        pool = FakeSessionPool()
+        storage = YDBStorage(session_pool=pool)
+
+        assert await storage.get_state(_key(1)) is None
+        await storage.set_state(_key(1), "a")
+
+        assert pool.queries == ["CREATE", "SELECT", "UPSERT"]
+
+    asyncio.run(scenario())
+
+
+def test_storage_needs_database():
+    with pytest.raises(ValueError):
+        YDBStorage()
+
+
+def test_exhausted_pool_is_not_retried():
+    async def scenario():
+        pool = FakeSessionPool(exhausted=True)
+        storage = YDBStorage(session_pool=pool)
+        await storage.start()
+        pool.acquired = 0
+
+        with pytest.raises(SessionPoolTimeout):
+            await storage._execute_query(storage._q_get_state, {})
+        assert pool.acquired == 1
+
+    asyncio.run(scenario())
+
+
+def test_unserializable_data_does_not_block_the_buffer():
+    async def scenario():
+        database = FakeDatabase()
+        storage = _buffered_storage(database)
+
+        await storage.set_data(_key(1), {"x": object()})
+        for user_id in range(2, 6):
+            await storage.set_state(_key(user_id), "a")
+        await asyncio.sleep(0.2)
+
+        assert storage._pending == {"state": {}, "data": {}}
+        assert len(database.flushes) == 1
+        assert database.flushes[0]["$data"] == []
+        assert len(database.flushes[0]["$states"]) == 4
+
+    asyncio.run(scenario())
+
+
+def test_non_retriable_flush_error_drops_the_batch():
+    async def scenario():
+        database = FakeDatabase(failures=1, error=ydb.SchemeError("no such table"))
+        storage = _buffered_storage(database)
+
+        await storage.set_state(_key(1), "a")
+        await asyncio.sleep(0.1)
+        await storage.set_state(_key(2), "b")
+        await asyncio.sleep(0.1)
+
+        assert storage._pending == {"state": {}, "data": {}}
+        assert [f["$states"] for f in database.flushes] == [
+            [{"key": "1:2:2", "state": "b"}]
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_close_stops_a_running_flush():
+    async def scenario():
+        database = FakeDatabase(delay=0.1)
+        storage = _buffered_storage(database)
+
+        await storage.set_state(_key(1), "a")
+        await asyncio.sleep(0.05)  # the flush is waiting for the database
+        await storage.close()
+        assert storage._flush_task.done()
+
+        flushes = len(database.flushes)
+        await asyncio.sleep(0.3)
+
+        assert len(database.flushes) == flushes
+        assert database.rows == {"1:2:1": {"key": "1:2:1", "state": "a"}}
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_buffered_updates_are_merged():
+    async def scenario():
+        database = FakeDatabase(delay=0.02)
+        storage = _buffered_storage(database)
+
+        await asyncio.gather(
+            storage.update_data(_key(1), {"a": 1}),
+            storage.update_data(_key(1), {"b": 2}),
+        )
+
+        assert await storage.get_data(_key(1)) == {"a": 1, "b": 2}
+
+    asyncio.run(scenario())
+
+
+def test_failed_start_stops_the_driver(monkeypatch):
+    drivers = []
+
+    class UnreachableDriver:
+        def __init__(self, driver_config) -> None:
+            self.stopped = False
+            drivers.append(self)
+
+        async def wait(self, timeout=None, fail_fast=False):
+            raise ydb.ConnectionError("YDB is unreachable")
+
+        async def stop(self, timeout=None):
+            self.stopped = True
+
+    monkeypatch.setattr(ydb.aio, "Driver", UnreachableDriver)
+
+    async def scenario():
+        storage = YDBStorage(driver_config=object())
+
+        for _ in range(2):
+            assert await storage.get_state(_key(1)) is None
+
+        assert len(drivers) == 2
+        assert all(driver.stopped for driver in drivers)
+        assert storage.driver is None
+
+    asyncio.run(scenario())